@@ -3,9 +3,11 @@
 # the full copyright notices and license terms.
 import os
 import re
+import hashlib
 import unicodedata
 import string
 import csv
+from collections import namedtuple
 from io import StringIO
 from datetime import datetime
 from trytond.config import config
@@ -21,6 +23,13 @@ __all__ = ['BaseExternalMapping',
     'CSVProfile', 'CSVProfileBaseExternalMapping', 'CSVArchive']
 
 
+# Profile configuration resolved once per archive (see CSVArchive._get_runtime)
+ImportRuntime = namedtuple('ImportRuntime', ['Base', 'base_mapping',
+        'children', 'create_record', 'update_record', 'testing',
+        'code_external', 'code_internal'])
+ImportChild = namedtuple('ImportChild', ['Model', 'mapping', 'rel_field'])
+
+
 def slugify(value):
     value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore')
     value = re.sub('[^\w\s-]', '', value.decode('utf-8')).strip().lower()
@@ -120,6 +129,8 @@ class CSVArchive(Workflow, ModelSQL, ModelView):
     date_archive = fields.DateTime('Date', required=True)
     data = fields.Function(fields.Binary('Archive', filename='archive_name',
         required=True), 'get_data', setter='set_data')
+    data_size = fields.Function(fields.Integer('Size'), 'get_data_size')
+    data_hash = fields.Function(fields.Char('Hash'), 'get_data_hash')
     archive_name = fields.Char('Archive Name')
     logs = fields.Text("Logs", readonly=True)
     state = fields.Selection([
@@ -155,26 +166,51 @@ class CSVArchive(Workflow, ModelSQL, ModelView):
                     },
                 })
 
-    def get_data(self, name):
-        path = os.path.join(config.get('database', 'path'),
+    @classmethod
+    def _archive_dir(cls):
+        return os.path.join(config.get('database', 'path'),
             Transaction().database.name, 'csv_import')
-        archive = '%s/%s' % (path, self.archive_name.replace(' ', '_'))
+
+    @property
+    def archive_path(self):
+        return '%s/%s' % (self._archive_dir(),
+            self.archive_name.replace(' ', '_'))
+
+    def get_data(self, name):
+        # Clients ask only for the size on list views and exports
+        context = Transaction().context
+        if context.get('%s.%s' % (self.__name__, name)) == 'size':
+            return self.get_data_size('data_size')
         try:
-            with open(archive, 'rb') as f:
+            with open(self.archive_path, 'rb') as f:
                 return fields.Binary.cast(f.read())
         except IOError:
             pass
 
+    def get_data_size(self, name):
+        try:
+            return os.path.getsize(self.archive_path)
+        except OSError:
+            pass
+
+    def get_data_hash(self, name):
+        sha = hashlib.sha256()
+        try:
+            with open(self.archive_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    sha.update(chunk)
+        except IOError:
+            return
+        return sha.hexdigest()
+
     @classmethod
     def set_data(cls, archives, name, value):
-        path = os.path.join(config.get('database', 'path'),
-            Transaction().database.name, 'csv_import')
+        path = cls._archive_dir()
         if not os.path.exists(path):
             os.makedirs(path, mode=0o777)
         for archive in archives:
-            archive = '%s/%s' % (path, archive.archive_name.replace(' ', '_'))
             try:
-                with open(archive, 'wb') as f:
+                with open(archive.archive_path, 'wb') as f:
                     f.write(value)
             except IOError:
                 raise UserError(gettext('csv_import.msg_error'))
@@ -183,10 +219,10 @@ class CSVArchive(Workflow, ModelSQL, ModelView):
     def on_change_profile(self):
         if self.profile:
             today = Pool().get('ir.date').today()
-            files = len(self.search([
-                        ('archive_name', 'like', '%s_%s_%s.csv' %
-                            (today, '%', slugify(self.profile.rec_name))),
-                    ]))
+            files = self.search_count([
+                    ('archive_name', 'like', '%s_%s_%s.csv' %
+                        (today, '%', slugify(self.profile.rec_name))),
+                    ])
             self.archive_name = '%s_%s_%s.csv' % \
                     (today, files, slugify(self.profile.rec_name))
         else:
@@ -336,22 +372,38 @@ class CSVArchive(Workflow, ModelSQL, ModelView):
         """
         pass
 
+    @classmethod
+    def _get_csv_format(cls, profile):
+        '''CSV reader keyword arguments from profile'''
+        separator = profile.csv_archive_separator
+        if separator == "tab":
+            separator = '\t'
+        return {
+            'delimiter': str(separator),
+            'quotechar': str(profile.csv_quote),
+            }
+
+    @classmethod
+    def _get_csv_width(cls, archive):
+        '''Number of columns of the first line, without loading the file'''
+        try:
+            with open(archive.archive_path, 'r', encoding='ascii',
+                    errors='replace', newline='') as f:
+                reader = csv.reader(f, **cls._get_csv_format(archive.profile))
+                return len(next(reader, []))
+        except (IOError, TypeError):
+            pass
+
     @classmethod
     def _read_csv_file(cls, archive):
         '''Read CSV data from archive'''
         headers = None
         profile = archive.profile
-
-        separator = profile.csv_archive_separator
-        if separator == "tab":
-            separator = '\t'
-        quote = profile.csv_quote
         header = profile.csv_header
 
         data = StringIO(archive.data.decode('ascii', errors='replace'))
         try:
-            reader = csv.reader(data, delimiter=str(separator),
-                quotechar=str(quote))
+            reader = csv.reader(data, **cls._get_csv_format(profile))
         except TypeError:
             cls.write([archive], {'logs': 'Error - %s' % (
                 gettext('csv_import.msg_read_error',
@@ -365,6 +417,38 @@ class CSVArchive(Workflow, ModelSQL, ModelView):
                 x.replace('"', '')))) for x in next(reader)]
         return reader, headers
 
+    @classmethod
+    def _get_runtime(cls, profile):
+        '''Resolve and validate profile and mappings before reading rows'''
+        pool = Pool()
+
+        base_model = profile.model.model
+        base_mapping = None
+        children = []
+        for mapping in profile.mappings:
+            if mapping.model.model == base_model:
+                base_mapping = mapping.name
+                continue
+            if not mapping.csv_rel_field:
+                raise UserError(gettext('csv_import.msg_missing_rel_field',
+                    mapping=mapping.rec_name))
+            children.append(ImportChild(pool.get(mapping.model.model),
+                mapping.name, mapping.csv_rel_field.name))
+        if not base_mapping:
+            raise UserError(gettext('csv_import.msg_not_mapping',
+                profile=profile.rec_name))
+
+        code_internal = None
+        if profile.update_record:
+            if not profile.code_internal:
+                raise UserError(gettext('csv_import.msg_missing_code_field',
+                    profile=profile.rec_name))
+            code_internal = profile.code_internal.name
+
+        return ImportRuntime(pool.get(base_model), base_mapping,
+            tuple(children), profile.create_record, profile.update_record,
+            profile.testing, profile.code_external or 0, code_internal)
+
     @classmethod
     @ModelView.button
     @Workflow.transition('done')
@@ -376,33 +460,52 @@ class CSVArchive(Workflow, ModelSQL, ModelView):
         '''
         pool = Pool()
         ExternalMapping = pool.get('base.external.mapping')
+        map_external_to_tryton = ExternalMapping.map_external_to_tryton
+        import_data = cls._import_data
 
-        logs = []
+        # Resolve every profile before reading any row, so a misconfiguration
+        # fails once instead of after importing the previous archives
+        runtimes = {}
+        to_import = []
         for archive in archives:
             profile = archive.profile
 
-            if not profile.create_record and not profile.update_record or not archive.data:
+            if (not profile.create_record and not profile.update_record
+                    or not archive.data_size):
                 continue
 
-            reader, headers = cls._read_csv_file(archive)
+            if profile.id not in runtimes:
+                runtimes[profile.id] = cls._get_runtime(profile)
+            runtime = runtimes[profile.id]
+
+            if runtime.update_record:
+                width = cls._get_csv_width(archive)
+                if (width is not None
+                        and not 0 <= runtime.code_external < width):
+                    raise UserError(gettext(
+                            'csv_import.msg_invalid_code_external',
+                            column=runtime.code_external,
+                            profile=profile.rec_name,
+                            archive=archive.rec_name))
+            to_import.append((archive, runtime))
 
-            base_model = profile.model.model
+        logs = []
+        for archive, runtime in to_import:
+            profile = archive.profile
+            Base = runtime.Base
+            base_mapping = runtime.base_mapping
+            children = runtime.children
+            create_record = runtime.create_record
+            update_record = runtime.update_record
+            testing = runtime.testing
+            code_external = runtime.code_external
+            code_internal = runtime.code_internal
 
-            child_mappings = []
-            for mapping in profile.mappings:
-                if not mapping.model.model == base_model:
-                    child_mappings.append(mapping)
-                else:
-                    base_mapping = mapping
-            if not base_mapping:
-                logs.append(gettext('csv_import.msg_not_mapping',
-                    profile=profile.rec_name))
-                continue
+            reader, headers = cls._read_csv_file(archive)
 
             new_records = []
             new_lines = []
             rows = list(reader)
-            Base = pool.get(base_model)
             for i in range(len(rows)):
                 row = rows[i]
                 if not row:
@@ -413,28 +516,19 @@ class CSVArchive(Workflow, ModelSQL, ModelView):
 
                 #get values base model
                 if not new_lines:
-                    base_values = ExternalMapping.map_external_to_tryton(
-                            base_mapping.name, vals)
+                    base_values = map_external_to_tryton(base_mapping, vals)
                     if not list(base_values.values()):
                         continue
                     if not list(base_values.values())[0] == '':
                         new_lines = []
 
                 #get values child models
-                child_values = None
                 child_rel_field = None
-                for child in child_mappings:
-                    if not child.csv_rel_field:
-                        logs.append(gettext('csv_import.msg_missing_rel_field',
-                            mapping=child.rec_name))
-                        continue
-                    child_rel_field = child.csv_rel_field.name
-                    child_values = ExternalMapping.map_external_to_tryton(
-                            child.name, vals)
-                    Child = pool.get(child.model.model)
-                    child = Child()
+                for child in children:
+                    child_rel_field = child.rel_field
+                    child_values = map_external_to_tryton(child.mapping, vals)
                     # get default values in child model
-                    child_values = cls._import_data(child, child_values,
+                    child_values = import_data(child.Model(), child_values,
                         base_values)
                     new_lines.append(child_values)
 
@@ -452,14 +546,14 @@ class CSVArchive(Workflow, ModelSQL, ModelView):
                 #create object or get object exist
                 record = None
                 records = None
-                if profile.update_record:
-                    val = row[profile.code_external]
+                if update_record:
+                    val = row[code_external]
                     records = Base.search([
-                            (profile.code_internal.name, '=', val)
+                            (code_internal, '=', val)
                             ])
                     if records:
                         record = Base(records[0])
-                if profile.create_record and not records:
+                if create_record and not records:
                     record = Base()
 
                 if not record:
@@ -468,10 +562,10 @@ class CSVArchive(Workflow, ModelSQL, ModelView):
                     continue
 
                 #get default values from base model
-                record = cls._import_data(record, base_values)
+                record = import_data(record, base_values)
 
                 #save - not testing
-                if not profile.testing:
+                if not testing:
                     try:
                         record.save()  # save or update
                     except (UserError, ValueError) as e:
@@ -481,7 +575,7 @@ class CSVArchive(Workflow, ModelSQL, ModelView):
                         record=record.id))
                     new_records.append(record.id)
 
-            if profile.testing:
+            if testing:
                 logs.append(gettext('csv_import.msg_success_simulation'))
 
             cls.post_import(profile, new_records)
@@ -1,13 +1,79 @@
-
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
-from trytond.tests.test_tryton import ModuleTestCase
+import os
+
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.exceptions import UserError
 
 
 class CsvImportTestCase(ModuleTestCase):
     'Test CsvImport module'
     module = 'csv_import'
 
+    def _create_lang_archive(self, **profile_values):
+        pool = Pool()
+        Model = pool.get('ir.model')
+        Field = pool.get('ir.model.field')
+        ExternalMapping = pool.get('base.external.mapping')
+        CSVProfile = pool.get('csv.profile')
+        CSVArchive = pool.get('csv.archive')
+
+        model, = Model.search([('model', '=', 'ir.lang')])
+        code_field, = Field.search([
+                ('model', '=', model.id),
+                ('name', '=', 'code'),
+                ])
+        mapping = ExternalMapping(name='lang.csv', model=model, state='done')
+        mapping.save()
+        profile = CSVProfile(name='Languages', model=model,
+            mappings=[mapping], update_record=True, code_internal=code_field,
+            **profile_values)
+        profile.save()
+        archive = CSVArchive(profile=profile, archive_name='lang.csv',
+            data=b'code\nxx\n')
+        archive.save()
+        self.addCleanup(os.remove, archive.archive_path)
+        return archive
+
+    @with_transaction()
+    def test_import_update_without_code_field(self):
+        'Test import fails before any row when update has no code field'
+        pool = Pool()
+        Lang = pool.get('ir.lang')
+        CSVProfile = pool.get('csv.profile')
+        CSVArchive = pool.get('csv.archive')
+
+        archive = self._create_lang_archive()
+
+        # The form requires the code field, so clear it behind its back
+        table = CSVProfile.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.update([table.code_internal], [None],
+                where=table.id == archive.profile.id))
+        Transaction().cache.clear()
+        archive, = CSVArchive.browse([archive.id])
+
+        langs = Lang.search([], count=True)
+        with self.assertRaises(UserError):
+            CSVArchive.import_csv([archive])
+        self.assertEqual(Lang.search([], count=True), langs)
+
+    @with_transaction()
+    def test_import_update_code_external_out_of_range(self):
+        'Test import fails before any row when code column is missing'
+        pool = Pool()
+        Lang = pool.get('ir.lang')
+        CSVArchive = pool.get('csv.archive')
+
+        archive = self._create_lang_archive(code_external=3)
+
+        langs = Lang.search([], count=True)
+        with self.assertRaises(UserError):
+            CSVArchive.import_csv([archive])
+        self.assertEqual(Lang.search([], count=True), langs)
+
 
 del ModuleTestCase